@@ -38,8 +38,11 @@ class AnalysisCallback:
 filter_registry = OperatorRegistry()
 
 
-def add_filter(name, function):
-    filter_registry[name] = AnalysisFilter(function)
+def add_filter(name, function, requires=None, vectorized=None):
+    halo_filter = AnalysisFilter(function)
+    halo_filter.requires = requires
+    halo_filter.vectorized_function = vectorized
+    filter_registry[name] = halo_filter
 
 
 class AnalysisFilter(AnalysisCallback):
@@ -47,14 +50,44 @@ class AnalysisFilter(AnalysisCallback):
     An AnalysisFilter is a function that minimally takes a target object, performs
     some analysis, and returns either True or False. The return value determines
     whether analysis is continued.
+
+    If given, requires is a function that accepts the same additional
+    arguments as the filter function and returns the names of the
+    quantities the filter reads.  This allows the filter to be run as
+    early as possible in the analysis pipeline.  The selectivity is an
+    optional estimate of the fraction of targets that pass the filter.
+
+    If given, vectorized_function evaluates the filter for many targets at
+    once.  It accepts a dictionary of quantity arrays followed by the same
+    additional arguments as the filter function and returns an array of
+    booleans.
     """
 
+    requires = None
+    selectivity = None
+    vectorized_function = None
+
     def __init__(self, function, *args, **kwargs):
         AnalysisCallback.__init__(self, function, args, kwargs)
 
     def __call__(self, target):
         return self.function(target, *self.args, **self.kwargs)
 
+    def dependencies(self):
+        """
+        Return the set of quantities read by this filter or None if unknown.
+        """
+        if self.requires is None:
+            return None
+        return set(self.requires(*self.args, **self.kwargs))
+
+    def vectorized(self, quantities):
+        """
+        Evaluate the filter for all targets given a dictionary of quantity
+        arrays, returning an array of booleans.
+        """
+        return self.vectorized_function(quantities, *self.args, **self.kwargs)
+
 
 quantity_registry = OperatorRegistry()
 
@@ -67,8 +100,14 @@ class AnalysisQuantity(AnalysisCallback):
     r"""
     An AnalysisQuantity is a function that takes minimally a target object,
     performs some analysis, and then returns a value.
+
+    If vectorized is True, the function is first tried on an object whose
+    quantities dictionary holds arrays of values for all targets, returning
+    an array of results.
     """
 
+    vectorized = False
+
     def __init__(self, function, *args, **kwargs):
         AnalysisCallback.__init__(self, function, args, kwargs)
 
@@ -5,9 +5,12 @@ AnalysisPipeline class and member functions
 
 """
 
+import heapq
 import os
 
-from yt.funcs import ensure_dir
+import numpy as np
+
+from yt.funcs import ensure_dir, mylog
 from yt_astro_analysis.halo_analysis.halo_catalog.analysis_operators import (
     callback_registry,
     filter_registry,
@@ -19,8 +22,14 @@ from yt_astro_analysis.halo_analysis.halo_catalog.analysis_operators import (
 class AnalysisPipeline:
     def __init__(self, output_dir=None):
         self.actions = []
+        self.optimize = True
+        self._ordered_actions = None
+        self._compiled_actions = None
+        self._vectorized_filters = []
+        self._unvectorized = set()
         self.quantities = []
         self.field_quantities = []
+        self._field_keys = {}
         if output_dir is None:
             output_dir = "."
         self.output_dir = output_dir
@@ -32,21 +41,28 @@ class AnalysisPipeline:
     def add_quantity(self, key, *args, **kwargs):
         from_data_source = kwargs.pop("from_data_source", False)
         field_type = kwargs.pop("field_type", None)
+        vectorized = kwargs.pop("vectorized", False)
 
         if not from_data_source:
             quantity = quantity_registry.find(key, *args, **kwargs)
+            if vectorized:
+                quantity.vectorized = True
         else:
             if field_type is None:
                 quantity = key
             else:
                 quantity = (field_type, key)
             self.field_quantities.append(quantity)
+            self._field_keys[key] = quantity
 
         self.quantities.append(key)
         self.actions.append(("quantity", (key, quantity)))
 
     def add_filter(self, halo_filter, *args, **kwargs):
+        selectivity = kwargs.pop("selectivity", None)
         halo_filter = filter_registry.find(halo_filter, *args, **kwargs)
+        if selectivity is not None:
+            halo_filter.selectivity = selectivity
         self.actions.append(("filter", halo_filter))
 
     def add_recipe(self, recipe, *args, **kwargs):
@@ -66,9 +82,248 @@ class AnalysisPipeline:
                 )
                 action.kwargs["output_dir"] = new_output_dir
 
-    def _process_target(self, target):
+    def _optimize_actions(self):
+        """
+        Determine the order in which actions will be run on each target.
+
+        Filters are moved forward to run as soon as the quantities they
+        depend on have been calculated, so that targets failing them skip
+        any unrelated quantities.  Filters are never moved ahead of a
+        callback added before them, since callbacks may modify any of the
+        target's quantities.  Among filters that are ready to run, those
+        with the lowest selectivity go first.  All other actions keep their
+        relative order.  Filters that do not declare their dependencies
+        stay where they are and nothing is moved across them.  Filters
+        that only depend on field quantities, have a vectorized form, and
+        are not preceded by any callback are removed from the list and
+        applied to all targets at once with _vectorized_mask.  If optimize
+        is False, actions are run in the order they were added.
+        """
+
+        self._vectorized_filters = []
+        self._unvectorized = set()
+        if not self.optimize:
+            self._ordered_actions = list(self.actions)
+            return self._ordered_actions
+
+        n_actions = len(self.actions)
+        requires = [set() for i in range(n_actions)]
+        producers = {}
+        field_producers = set()
+        vectorized = set()
+        last = None
+        last_callback = None
+        barrier = None
+        for i, (action_type, action) in enumerate(self.actions):
+            if action_type == "filter":
+                deps = _get_dependencies(action)
+                if deps is None or not deps.issubset(producers):
+                    requires[i].update(range(i))
+                    barrier = i
+                else:
+                    requires[i].update(producers[dep] for dep in deps)
+                    if barrier is not None:
+                        requires[i].add(barrier)
+                    if last_callback is not None:
+                        requires[i].add(last_callback)
+                    # callbacks may modify the quantities taken from fields
+                    from_fields = last_callback is None and all(
+                        producers[dep] in field_producers for dep in deps
+                    )
+                    if from_fields and _has_vectorized_form(action):
+                        vectorized.add(i)
+                continue
+
+            if last is not None:
+                requires[i].add(last)
+            if barrier is not None:
+                requires[i].add(barrier)
+            last = i
+            if action_type == "callback":
+                last_callback = i
+            if action_type == "quantity":
+                producers[action[0]] = i
+                if not callable(action[1]):
+                    field_producers.add(i)
+
+        dependents = [[] for i in range(n_actions)]
+        for i, my_requires in enumerate(requires):
+            for j in my_requires:
+                dependents[j].append(i)
+        n_requires = [len(my_requires) for my_requires in requires]
+
+        def _priority(i):
+            action_type, action = self.actions[i]
+            if action_type != "filter":
+                return (1, 0, i)
+            selectivity = getattr(action, "selectivity", None)
+            if selectivity is None:
+                selectivity = 1
+            return (0, selectivity, i)
+
+        queue = [_priority(i) for i in range(n_actions) if n_requires[i] == 0]
+        heapq.heapify(queue)
+        ordered = []
+        while queue:
+            i = heapq.heappop(queue)[-1]
+            if i in vectorized:
+                self._vectorized_filters.append(self.actions[i][1])
+            else:
+                ordered.append(self.actions[i])
+            for j in dependents[i]:
+                n_requires[j] -= 1
+                if n_requires[j] == 0:
+                    heapq.heappush(queue, _priority(j))
+
+        self._ordered_actions = ordered
+        return ordered
+
+    def _vectorized_mask(self, field_cache, n_targets):
+        """
+        Return a boolean array marking the targets that pass all of the
+        filters that can be applied to field quantities in vectorized form.
+        """
+
+        mask = np.ones(n_targets, dtype=bool)
+        if not self._vectorized_filters:
+            return mask
+
+        quantities = {
+            key: field_cache[field] for key, field in self._field_keys.items()
+        }
+        for halo_filter in self._vectorized_filters:
+            mask &= halo_filter.vectorized(quantities)
+        return mask
+
+    def _compile_actions(self):
+        """
+        Generate a single function that runs all actions on a target.
+
+        The function is equivalent to _process_target, but with the
+        dispatch on action type done once here instead of for every action
+        on every target.  It accepts a target and a dictionary of field
+        arrays.  This should be called after _optimize_actions and before
+        any targets are processed.
+        """
+
+        actions = self._ordered_actions
+        if actions is None:
+            actions = self.actions
+
+        # Attributes of the target are looked up every time, since callbacks
+        # may replace them, e.g., with a new quantities dictionary.
+        namespace = {}
+        lines = ["def _process(target, field_cache):"]
+        for i, (action_type, action) in enumerate(actions):
+            if action_type == "callback":
+                namespace[f"_callback_{i}"] = action
+                lines.append(f"    _callback_{i}(target)")
+            elif action_type == "filter":
+                namespace[f"_filter_{i}"] = action
+                lines.append(f"    if not _filter_{i}(target):")
+                lines.append("        return False")
+            elif action_type == "quantity":
+                key, quantity = action
+                namespace[f"_key_{i}"] = key
+                if callable(quantity):
+                    namespace[f"_function_{i}"] = quantity.function
+                    namespace[f"_args_{i}"] = quantity.args
+                    namespace[f"_kwargs_{i}"] = quantity.kwargs
+                    call = f"_function_{i}(target, *_args_{i}, **_kwargs_{i})"
+                    if not quantity.vectorized:
+                        lines.append(f"    target.quantities[_key_{i}] = {call}")
+                        continue
+                    namespace[f"_quantity_{i}"] = quantity
+                    lines.extend(
+                        [
+                            f"    column = field_cache.get(_quantity_{i})",
+                            "    if column is None:",
+                            f"        target.quantities[_key_{i}] = {call}",
+                            "    else:",
+                            f"        target.quantities[_key_{i}] = column[target.index]",
+                        ]
+                    )
+                else:
+                    namespace[f"_field_{i}"] = quantity
+                    lines.append(
+                        f"    target.quantities[_key_{i}] = "
+                        f"field_cache[_field_{i}][target.index]"
+                    )
+            else:
+                raise RuntimeError("Action must be a callback, filter, or quantity.")
+        lines.append("    return True")
+
+        exec("\n".join(lines), namespace)
+        self._compiled_actions = namespace["_process"]
+        return self._compiled_actions
+
+    def _vectorize_quantities(self, field_cache, n_targets):
+        """
+        Calculate vectorized quantities for all targets at once.
+
+        Each vectorized quantity is called on an object whose quantities
+        dictionary holds the arrays of all field quantities and previously
+        vectorized quantities.  Since callbacks may modify any quantity,
+        values from before a callback are not made available after it.
+        Results are added to field_cache, keyed by the quantity object.
+        Quantities for which this fails are calculated for each target
+        individually for the rest of the run.
+        """
+
+        actions = self._ordered_actions
+        if actions is None:
+            actions = self.actions
+
+        columns = {}
+        for i, (action_type, action) in enumerate(actions):
+            if action_type == "callback":
+                columns.clear()
+            if action_type != "quantity":
+                continue
+            key, quantity = action
+            if not callable(quantity):
+                columns[key] = field_cache[quantity]
+                continue
+
+            columns.pop(key, None)
+            if not quantity.vectorized or i in self._unvectorized:
+                continue
+            try:
+                values = quantity(_QuantityColumns(columns))
+                if np.shape(values)[:1] != (n_targets,):
+                    raise ValueError(
+                        f"expected {n_targets} values, got shape {np.shape(values)}"
+                    )
+            except Exception as err:
+                mylog.warning(
+                    "Cannot vectorize quantity %s, calculating it for each "
+                    "target instead: %s",
+                    key,
+                    err,
+                )
+                self._unvectorized.add(i)
+                continue
+
+            columns[key] = field_cache[quantity] = values
+
+    def _process_target(self, target, field_cache=None):
+        """
+        Run all actions on a single target.
+
+        If given, field_cache is a dictionary of field arrays for the
+        current chunk, keyed by field name.  Field quantities are then
+        taken from it instead of being looked up on the data source.
+        """
+
+        if field_cache is not None and self._compiled_actions is not None:
+            return self._compiled_actions(target, field_cache)
+
+        actions = self._ordered_actions
+        if actions is None:
+            actions = self.actions
+
         target_filter = True
-        for action_type, action in self.actions:
+        for action_type, action in actions:
             if action_type == "callback":
                 action(target)
             elif action_type == "filter":
@@ -78,10 +333,40 @@ class AnalysisPipeline:
             elif action_type == "quantity":
                 key, quantity = action
                 if callable(quantity):
-                    target.quantities[key] = quantity(target)
-                else:
+                    column = None
+                    if field_cache is not None and quantity.vectorized:
+                        column = field_cache.get(quantity)
+                    if column is None:
+                        target.quantities[key] = quantity(target)
+                    else:
+                        target.quantities[key] = column[target.index]
+                elif field_cache is None:
                     target._set_field_value(key, quantity)
+                else:
+                    target.quantities[key] = field_cache[quantity][target.index]
             else:
                 raise RuntimeError("Action must be a callback, filter, or quantity.")
 
         return target_filter
+
+
+def _get_dependencies(action):
+    "Return the quantities read by a filter or None if unknown."
+
+    get_dependencies = getattr(action, "dependencies", None)
+    if get_dependencies is None:
+        return None
+    return get_dependencies()
+
+
+def _has_vectorized_form(action):
+    "Return True if a filter can be applied to many targets at once."
+
+    return getattr(action, "vectorized_function", None) is not None
+
+
+class _QuantityColumns:
+    "Stand-in for a target holding quantity arrays for many targets."
+
+    def __init__(self, quantities):
+        self.quantities = quantities
@@ -5,8 +5,8 @@ HaloCatalog class and member functions
 
 """
 
-import functools
 import os
+from collections import OrderedDict
 
 import numpy as np
 from unyt import unyt_array
@@ -14,6 +14,8 @@ from unyt import unyt_array
 from yt.data_objects.time_series import DatasetSeries
 from yt.frontends.ytdata.utilities import save_as_dataset
 from yt.funcs import ensure_dir, mylog
+from yt.utilities.lib.geometry_utils import compute_morton
+from yt.utilities.on_demand_imports import _h5py as h5py
 from yt.utilities.parallel_tools.parallel_analysis_interface import (
     ParallelAnalysisInterface,
     parallel_blocking_call,
@@ -35,6 +37,129 @@ _default_fields = (
 )
 
 
+_initial_catalog_size = 1024
+_max_block_size = 64
+
+
+def _catalog_field_dtype(key, value):
+    "Return the structured dtype entry for a quantity with the given value."
+    if isinstance(value, unyt_array):
+        # values may need unit conversion, so never store them as integers
+        dtype = np.result_type(value.dtype, np.float64)
+    else:
+        dtype = np.asarray(value).dtype
+        if dtype.kind not in "biufc":
+            dtype = np.dtype(object)
+    return (key, dtype, np.shape(value))
+
+
+_max_chunk_size = 1 << 20
+# lossless compression used for all catalog fields
+_compression_kwargs = {"compression": "gzip", "compression_opts": 4, "shuffle": True}
+# Streamed fields are written in blocks of unknown total length, so their
+# chunks are sized to hold about this many bytes.
+_stream_chunk_bytes = 1 << 20
+_min_stream_chunk_size = 1 << 10
+
+
+def _save_catalog_file(ds, filename, data, field_types, extra_attrs):
+    """
+    Save field arrays to a yt-loadable dataset.
+
+    The file layout is the same as that of save_as_dataset, but each field
+    is written in a single call as a chunked dataset with lossless
+    compression.
+    """
+
+    with quiet():
+        save_as_dataset(ds, filename, {}, extra_attrs=extra_attrs)
+
+    with h5py.File(filename, mode="a") as fh:
+        for field, values in data.items():
+            group = fh.require_group(field_types[field])
+            if isinstance(field, tuple):
+                field = field[1]
+
+            if values.dtype.kind == "U":
+                values = values.astype("|S")
+
+            dataset_kwargs = {}
+            if values.size > 0:
+                chunks = (min(values.shape[0], _max_chunk_size),) + values.shape[1:]
+                dataset_kwargs.update(chunks=chunks, **_compression_kwargs)
+            dataset = group.create_dataset(
+                str(field), data=np.asarray(values), **dataset_kwargs
+            )
+
+            units = ""
+            if isinstance(values, unyt_array):
+                units = str(values.units)
+            dataset.attrs["units"] = units
+            if "num_elements" not in group.attrs:
+                group.attrs["num_elements"] = values.size
+
+
+def _morton_keys(ds, positions):
+    "Return the Morton (Z-order) keys of positions within the domain of ds."
+
+    left_edge = ds.domain_left_edge.to("code_length").d
+    right_edge = ds.domain_right_edge.to("code_length").d
+    coords = []
+    for i, values in enumerate(positions):
+        values = values.to("code_length").d.astype(np.float64)
+        upper = np.nextafter(right_edge[i], left_edge[i])
+        coords.append(np.clip(values, left_edge[i], upper))
+    return compute_morton(*coords, left_edge, right_edge)
+
+
+def _append_catalog_field(group, field, values, start):
+    """
+    Write field values to rows start onward of a resizable dataset.
+
+    The dataset is created if it does not exist and is rewritten with a
+    promoted dtype if it cannot hold the new values.
+    """
+
+    if values.dtype.kind == "U":
+        values = values.astype("|S")
+    units = ""
+    if isinstance(values, unyt_array):
+        units = str(values.units)
+    values = np.asarray(values)
+    end = start + values.shape[0]
+    shape = values.shape[1:]
+
+    old_values = None
+    dataset = group.get(field)
+    if dataset is not None:
+        dtype = np.result_type(dataset.dtype, values.dtype)
+        if dtype != dataset.dtype:
+            old_values = dataset[:start]
+            del group[field]
+            dataset = None
+    else:
+        dtype = values.dtype
+
+    if dataset is None:
+        row_size = dtype.itemsize * int(np.prod(shape))
+        chunk_size = _stream_chunk_bytes // max(row_size, 1)
+        chunk_size = min(max(chunk_size, _min_stream_chunk_size), _max_chunk_size)
+        dataset = group.create_dataset(
+            field,
+            shape=(start,) + shape,
+            maxshape=(None,) + shape,
+            dtype=dtype,
+            chunks=(chunk_size,) + shape,
+            **_compression_kwargs,
+        )
+        if old_values is not None:
+            dataset[:start] = old_values
+
+    dataset.resize(end, axis=0)
+    dataset[start:end] = values
+    dataset.attrs["units"] = units
+
+
 class HaloCatalog(ParallelAnalysisInterface):
     r"""Create a HaloCatalog: an object that allows for the creation and association
     of data with a set of halo objects.
@@ -69,6 +194,18 @@ class HaloCatalog(ParallelAnalysisInterface):
         Default: "halo_catalogs"
     finder_kwargs : dict
         Arguments to pass to the halo finder if finder_method is given.
+    field_cache_size : int
+        The number of chunks of the halo dataset for which field data are
+        kept in memory and reused by later calls to create or load.  Set
+        to 0 to disable.  The cache can be emptied with clear_field_cache.
+        Default: 4
+    parallel_read : bool
+        If True, each processor reads field data from the halo dataset
+        itself.  If False, only the root processor reads them and sends
+        them to all others.  Reading on all processors avoids making the
+        root processor a bottleneck when running on many processors with
+        a parallel file system.
+        Default: False
 
     Examples
     --------
@@ -116,6 +253,8 @@ class HaloCatalog(ParallelAnalysisInterface):
         finder_method=None,
         finder_kwargs=None,
         output_dir=None,
+        field_cache_size=4,
+        parallel_read=False,
     ):
         super().__init__()
 
@@ -142,6 +281,14 @@ class HaloCatalog(ParallelAnalysisInterface):
         self.output_basedir = ensure_dir(output_dir)
         self.pipeline = AnalysisPipeline(output_dir=self.output_dir)
         self.quantities = self.pipeline.quantities
+        self._catalog = None
+        self._n_catalog = 0
+        self._n_catalog_quantities = 0
+        self.catalog_units = {}
+        self.field_cache_size = field_cache_size
+        self.parallel_read = parallel_read
+        self._chunk_data_cache = OrderedDict()
+        self._chunk_data_source = None
 
         self.finder_method_name = finder_method
         if finder_kwargs is None:
@@ -167,6 +314,11 @@ class HaloCatalog(ParallelAnalysisInterface):
             self.add_quantity(field, from_data_source=True, field_type=field_type)
 
     _source_ds = None
+    _field_cache = None
+    _halo_pool = None
+    _catalog_file = None
+    _n_saved = 0
+    _save_info = None
 
     @property
     def source_ds(self):
@@ -197,7 +349,9 @@ class HaloCatalog(ParallelAnalysisInterface):
     def output_dir(self):
         return os.path.join(self.output_basedir, self.output_basename)
 
-    def _yield_halos(self, njobs="auto", dynamic=False):
+    def _yield_halos(
+        self, njobs="auto", dynamic=False, cost_field=None, spatial_order=False
+    ):
         my_size = self.comm.size
 
         if njobs == "auto":
@@ -208,101 +362,463 @@ class HaloCatalog(ParallelAnalysisInterface):
             my_dynamic = dynamic
             my_njobs = njobs
 
-        for chunk in self.data_source.chunks([], "io"):
-            if self.comm.rank == 0:
-                chunk.get_data(self.pipeline.field_quantities)
+        id_field = (self.halo_field_type, self._id_field)
+        fields = self.pipeline.field_quantities + [id_field]
+        if cost_field is not None:
+            cost_field = (self.halo_field_type, cost_field)
+            fields.append(cost_field)
+        if spatial_order:
+            position_fields = [
+                (self.halo_field_type, f"particle_position_{ax}") for ax in "xyz"
+            ]
+            fields.extend(position_fields)
+        fields = list(dict.fromkeys(fields))
+
+        if self._chunk_data_source is not self.data_source:
+            self.clear_field_cache()
+            self._chunk_data_source = self.data_source
+
+        for i, chunk in enumerate(self.data_source.chunks([], "io")):
+            self._get_chunk_data(i, chunk, fields)
+
+            # Look up each field once per chunk instead of once per halo.
+            chunk_fields = {field: chunk[field] for field in fields}
+            self._field_cache = {
+                field: chunk_fields[field] for field in self.pipeline.field_quantities
+            }
+
+            n_halos = chunk_fields[id_field].size
+            self.pipeline._vectorize_quantities(self._field_cache, n_halos)
+
+            # Apply any filters that can operate on the whole chunk at once
+            # so that the halos they remove are never handed out.
+            target_indices = np.flatnonzero(
+                self.pipeline._vectorized_mask(self._field_cache, n_halos)
+            )
+
+            if cost_field is not None:
+                # Hand out the most expensive halos first so no processor
+                # is left working on a large halo after the others finish.
+                cost = chunk_fields[cost_field].d[target_indices]
+                target_indices = target_indices[np.argsort(-cost, kind="stable")]
+
+            if spatial_order:
+                # Analyze neighboring halos one after another so that
+                # callbacks can reuse the simulation data already read.
+                morton = np.empty(n_halos, dtype=np.uint64)
+                morton[target_indices] = _morton_keys(
+                    self.halos_ds,
+                    [chunk_fields[field][target_indices] for field in position_fields],
+                )
+                if cost_field is None:
+                    order = np.argsort(morton[target_indices], kind="stable")
+                    target_indices = target_indices[order]
+
+            # Hand out halos in blocks to avoid dispatching them one at a
+            # time.  Blocks take every n-th halo so that each gets a similar
+            # mix of halos when they are sorted by cost.
+            if my_dynamic:
+                # Give each worker several blocks so that the queue can
+                # still balance the load when there are few halos.  Rank 0
+                # only hands out blocks.
+                n_workers = my_njobs if my_njobs > 0 else my_size - 1
+                block_size = target_indices.size // (4 * n_workers)
+                block_size = max(1, min(_max_block_size, block_size))
+                n_blocks = -(-target_indices.size // block_size)
+            elif my_njobs <= 0:
+                n_blocks = my_size
+            else:
+                n_blocks = my_njobs
+            if spatial_order and cost_field is None:
+                # contiguous blocks keep neighboring halos together
+                blocks = np.array_split(target_indices, n_blocks) if n_blocks else []
+            else:
+                blocks = [target_indices[i::n_blocks] for i in range(n_blocks)]
+                if spatial_order:
+                    blocks = [
+                        block[np.argsort(morton[block], kind="stable")]
+                        for block in blocks
+                    ]
+
+            for my_block in parallel_objects(
+                blocks, njobs=my_njobs, dynamic=my_dynamic
+            ):
+                for my_index in my_block:
+                    # Reuse the same halo object unless the last one was kept.
+                    if self._halo_pool is None:
+                        self._halo_pool = Halo(self, chunk, my_index)
+                    else:
+                        self._halo_pool._reset(chunk, my_index)
+                    yield self._halo_pool
+
+    def _get_chunk_data(self, i, chunk, fields):
+        """
+        Read field data for the i-th chunk of the data source.
 
-            if my_size > 1:
-                fdata = self.comm.comm.bcast(chunk.field_data, root=0)
-                chunk.field_data.update(fdata)
+        Field data from recent chunks are kept and reused if the same
+        chunk is read again by a later run.
+        """
 
-            target_indices = range(chunk[self.halo_field_type, self._id_field].size)
-            my_indices = parallel_objects(
-                target_indices, njobs=my_njobs, dynamic=my_dynamic
-            )
+        cache = self._chunk_data_cache
+        cached = cache.get(i)
+        if cached is not None and all(field in cached for field in fields):
+            cache.move_to_end(i)
+            chunk.field_data.update(cached)
+            return
+
+        if self.parallel_read or self.comm.rank == 0:
+            chunk.get_data(fields)
+
+        if self.comm.size > 1 and not self.parallel_read:
+            self._broadcast_field_data(chunk)
+
+        if self.field_cache_size > 0:
+            cache[i] = {field: chunk.field_data[field] for field in fields}
+            cache.move_to_end(i)
+            while len(cache) > self.field_cache_size:
+                cache.popitem(last=False)
+
+    def clear_field_cache(self):
+        r"""
+        Free field data from the halo dataset kept from previous runs.
+
+        Examples
+        --------
+
+        >>> hc.load()
+        >>> hc.clear_field_cache()
+
+        """
 
-            for my_index in my_indices:
-                my_halo = Halo(self, chunk, my_index)
-                yield my_halo
+        self._chunk_data_cache.clear()
+
+    def _broadcast_field_data(self, chunk):
+        """
+        Send the field data read by the root process to all others.
+
+        Only the shape, dtype, and units of each field are pickled.  Numeric
+        arrays are then broadcast directly from their buffers.
+        """
+
+        comm = self.comm.comm
+        is_root = self.comm.rank == 0
+
+        if is_root:
+            info = {}
+            for field, values in chunk.field_data.items():
+                if values.dtype.kind not in "biufc":
+                    info[field] = values
+                    continue
+                units = None
+                if isinstance(values, unyt_array):
+                    units = str(values.units)
+                info[field] = (values.shape, values.dtype.str, units)
+        else:
+            info = None
+        info = comm.bcast(info, root=0)
+
+        for field, field_info in info.items():
+            if not isinstance(field_info, tuple):
+                if not is_root:
+                    chunk.field_data[field] = field_info
+                continue
+
+            shape, dtype, units = field_info
+            if is_root:
+                buff = np.ascontiguousarray(chunk.field_data[field].view(np.ndarray))
+            else:
+                buff = np.empty(shape, dtype=dtype)
+            comm.Bcast(buff, root=0)
+            if is_root:
+                continue
+
+            if units is None:
+                chunk.field_data[field] = buff
+            else:
+                chunk.field_data[field] = self.halos_ds.arr(buff, units)
 
     @parallel_blocking_call
-    def _run(self, save_halos, save_catalog, njobs="auto", dynamic=False):
+    def _run(
+        self,
+        save_halos,
+        save_catalog,
+        njobs="auto",
+        dynamic=False,
+        cost_field=None,
+        buffer_size=None,
+        spatial_order=False,
+    ):
         """
         Run analysis pipeline on all halos.
 
         This is used by both load and create.
         """
 
+        self._save_info = None
+
         # Find halos.
         if self.halos_ds is None:
             self.finder_method(self)
             return
 
         self.pipeline._preprocess()
+        self.pipeline._optimize_actions()
+        self.pipeline._compile_actions()
 
-        self.catalog = []
+        self._catalog = None
+        self._n_catalog = 0
+        self._n_catalog_quantities = 0
+        self.catalog_units = {}
         if save_halos:
             self.halo_list = []
 
-        for my_halo in self._yield_halos(njobs=njobs, dynamic=dynamic):
-            rval = self.pipeline._process_target(my_halo)
+        stream = save_catalog and buffer_size is not None
+        if stream:
+            self._open_catalog_file()
+
+        try:
+            for my_halo in self._yield_halos(
+                njobs=njobs,
+                dynamic=dynamic,
+                cost_field=cost_field,
+                spatial_order=spatial_order,
+            ):
+                rval = self.pipeline._process_target(my_halo, self._field_cache)
+                my_halo._memo.clear()
+
+                if rval:
+                    self._append_to_catalog(my_halo.quantities)
+                    if stream and self._n_catalog >= buffer_size:
+                        self._flush_catalog()
+
+                if save_halos and rval:
+                    # the catalog is converted to base units when saved,
+                    # but kept halos need their quantities converted here
+                    quantities = my_halo.quantities
+                    for key, value in quantities.items():
+                        if isinstance(value, unyt_array):
+                            quantities[key] = value.in_base()
+                    self.halo_list.append(my_halo)
+                    # keep this one and start a new halo object for the next
+                    self._halo_pool = None
+
+            if stream:
+                self._flush_catalog()
+        finally:
+            if stream:
+                self._close_catalog_file()
+            # do not hold on to the last halo or chunk after the run
+            self._halo_pool = None
+            self._field_cache = None
+
+        if save_catalog and not stream:
+            self._save()
+
+    @property
+    def catalog(self):
+        """
+        Structured array with one field per quantity for all halos in the
+        catalog.  The units of each field are given in catalog_units.
+        """
+        if self._catalog is None:
+            # a quantity may have been added more than once
+            keys = dict.fromkeys(self.quantities)
+            return np.empty(0, dtype=[(key, object) for key in keys])
+        return self._catalog[: self._n_catalog]
+
+    def _append_to_catalog(self, quantities):
+        """
+        Add the quantities for a single halo to the catalog.
 
-            if rval:
-                for quantity in my_halo.quantities.values():
-                    if hasattr(quantity, "units"):
-                        quantity.convert_to_base()
-                self.catalog.append(my_halo.quantities)
+        The catalog is a structured array, preallocated and grown as
+        needed.  The units of each quantity are taken from the first halo
+        and values are converted to them.
+        """
 
-            if save_halos and rval:
-                self.halo_list.append(my_halo)
+        catalog = self._catalog
+        if catalog is None or len(self.quantities) != self._n_catalog_quantities:
+            self._extend_catalog(quantities)
+        elif self._n_catalog >= catalog.size:
+            self._resize_catalog(catalog.dtype, 2 * catalog.size)
+
+        promote = []
+        row = []
+        fields = self._catalog.dtype.fields
+        for key in self._catalog_keys:
+            value = quantities[key]
+            units = self.catalog_units[key]
+            if units is not None:
+                # values taken from the same field share its units object
+                if value.units is not units and value.units != units:
+                    value = value.to(units)
+                value = value.d
             else:
-                del my_halo
+                field_dtype = fields[key][0].base
+                if field_dtype != object and not np.can_cast(
+                    np.asarray(value).dtype, field_dtype, casting="same_kind"
+                ):
+                    promote.append(key)
+            row.append(value)
+
+        if promote:
+            dtype = []
+            for key in self._catalog_keys:
+                field_dtype = fields[key][0]
+                if key in promote:
+                    new_base = np.result_type(
+                        field_dtype.base, np.asarray(quantities[key]).dtype
+                    )
+                    field_dtype = np.dtype((new_base, field_dtype.shape))
+                dtype.append((key, field_dtype))
+            self._resize_catalog(dtype, self._catalog.size)
+
+        self._catalog[self._n_catalog] = tuple(row)
+        self._n_catalog += 1
+
+    def _extend_catalog(self, quantities):
+        "Add fields to the catalog for any new quantities."
+
+        # a quantity may have been added more than once
+        keys = list(dict.fromkeys(self.quantities))
+        self._catalog_keys = keys
+        self._n_catalog_quantities = len(self.quantities)
+
+        dtype = []
+        for key in keys:
+            if self._catalog is not None and key in self._catalog.dtype.names:
+                dtype.append((key, self._catalog.dtype.fields[key][0]))
+                continue
+            value = quantities[key]
+            dtype.append(_catalog_field_dtype(key, value))
+            units = value.units if isinstance(value, unyt_array) else None
+            self.catalog_units[key] = units
+
+        size = _initial_catalog_size
+        if self._catalog is not None:
+            size = max(self._catalog.size, 2 * self._n_catalog)
+        self._resize_catalog(dtype, size)
+
+    def _resize_catalog(self, dtype, size):
+        "Copy the catalog into a new array with the given dtype and size."
+
+        new_catalog = np.zeros(size, dtype=dtype)
+        if self._catalog is not None:
+            n_halos = self._n_catalog
+            for key in self._catalog.dtype.names:
+                new_catalog[key][:n_halos] = self._catalog[key][:n_halos]
+        self._catalog = new_catalog
+
+    def _catalog_data(self):
+        """
+        Return the catalog as a dictionary of arrays with units.
 
-        if save_catalog:
-            self._save()
+        Values are converted to base units one column at a time here
+        rather than for each halo.
+        """
+
+        data = {}
+        if self._n_catalog == 0:
+            return data
+
+        catalog = self.catalog
+        for key in self.quantities:
+            column = catalog[key]
+            if column.dtype == object:
+                column = np.array(column.tolist())
+            units = self.catalog_units[key]
+            if units is not None:
+                column = unyt_array(column, units).in_base()
+            data[key] = column
+        return data
+
+    def _get_save_info(self):
+        """
+        Return the filename, default field types, and attributes for
+        saving the catalog.
+
+        These only depend on the source dataset and the quantities, so
+        they are set up once and reused by each save.
+        """
+
+        if self._save_info is None:
+            data_dir = ensure_dir(self.output_dir)
+            filename = os.path.join(
+                data_dir, f"{self.output_basename}.{self.comm.rank}.h5"
+            )
+            field_types = {key: "." for key in self.quantities}
+            extra_attrs = {"data_type": "halo_catalog"}
+            self._save_info = (filename, field_types, extra_attrs)
+        return self._save_info
+
+    def _open_catalog_file(self):
+        "Write the catalog header and keep the file open for streaming."
+
+        filename, _, extra_attrs = self._get_save_info()
+        extra_attrs = dict(extra_attrs, num_halos=0)
+        with quiet():
+            save_as_dataset(self.source_ds, filename, {}, extra_attrs=extra_attrs)
+        self._catalog_file = h5py.File(filename, mode="a")
+        self._n_saved = 0
+
+    def _flush_catalog(self):
+        "Append the halos in the catalog to the open catalog file and empty it."
+
+        start = self._n_saved
+        for key, values in self._catalog_data().items():
+            _append_catalog_field(self._catalog_file, key, values, start)
+        self._n_saved += self._n_catalog
+        self._n_catalog = 0
+
+    def _close_catalog_file(self):
+        "Record the number of halos written and close the catalog file."
+
+        fh = self._catalog_file
+        mylog.info("Saved %d halos: %s.", self._n_saved, fh.filename)
+        fh.attrs["num_halos"] = self._n_saved
+        if len(fh) > 0 and "num_elements" not in fh.attrs:
+            fh.attrs["num_elements"] = self._n_saved
+        fh.close()
+        self._catalog_file = None
 
     def _save(self, ds=None, data=None, extra_attrs=None, field_types=None):
         "Save new halo catalog."
 
         if ds is None:
             ds = self.source_ds
-        else:
+        elif ds is not self._source_ds:
+            # the output filename depends on the source dataset
             self._source_ds = ds
+            self._save_info = None
 
-        data_dir = ensure_dir(self.output_dir)
-        filename = os.path.join(data_dir, f"{self.output_basename}.{self.comm.rank}.h5")
+        filename, default_field_types, base_attrs = self._get_save_info()
 
         if data is None:
-            n_halos = len(self.catalog)
-            data = {}
-            if n_halos > 0:
-                for key in self.quantities:
-                    if hasattr(self.catalog[0][key], "units"):
-                        registry = self.catalog[0][key].units.registry
-                        my_arr = functools.partial(unyt_array, registry=registry)
-                    else:
-                        my_arr = np.array
-
-                    data[key] = my_arr([halo[key] for halo in self.catalog])
+            n_halos = self._n_catalog
+            data = self._catalog_data()
         else:
             n_halos = data[self._id_field].size
 
         mylog.info("Saving %d halos: %s.", n_halos, filename)
 
         if field_types is None:
-            field_types = {key: "." for key in self.quantities}
+            field_types = default_field_types
 
-        if extra_attrs is None:
-            extra_attrs = {}
-        extra_attrs_d = {"data_type": "halo_catalog", "num_halos": n_halos}
-        extra_attrs_d.update(extra_attrs)
+        extra_attrs_d = dict(base_attrs, num_halos=n_halos)
+        if extra_attrs is not None:
+            extra_attrs_d.update(extra_attrs)
 
-        with quiet():
-            save_as_dataset(
-                ds, filename, data, field_types=field_types, extra_attrs=extra_attrs_d
-            )
+        _save_catalog_file(ds, filename, data, field_types, extra_attrs_d)
 
-    def create(self, save_halos=False, save_output=True, njobs="auto", dynamic=False):
+    def create(
+        self,
+        save_halos=False,
+        save_output=True,
+        njobs="auto",
+        dynamic=False,
+        cost_field=None,
+        buffer_size=None,
+        spatial_order=False,
+    ):
         r"""
         Create the halo catalog given the callbacks, quantities, and filters that
         have been provided.
@@ -331,6 +847,28 @@ class HaloCatalog(ParallelAnalysisInterface):
             If True, parallelism is performed via a task queue. If njobs is set to
             "auto", behavior is controlled in the way described above.
             Default: False
+        cost_field : string
+            If not None, a field from the halo dataset, such as
+            "particle_mass", used to estimate the cost of analyzing each
+            halo.  Halos are then handed out to processors from most to least
+            expensive to balance the work between them.  Note, this also
+            changes the order of halos in the resulting catalog.
+            Default: None
+        buffer_size : int
+            If not None and save_output is True, the catalog is written to
+            disk every time this many halos have been added to it, keeping
+            memory use bounded for very large catalogs.  The catalog
+            attribute is then empty after the catalog has been written.
+            Default: None
+        spatial_order : bool
+            If True, halos are analyzed in order along a space-filling curve
+            so that neighboring halos are analyzed one after another and
+            by the same processor.  This can speed up callbacks that read
+            simulation data around each halo.  If cost_field is also given,
+            halos are still handed out by cost, but each processor analyzes
+            its halos in spatial order.  Note, this also changes the order
+            of halos in the resulting catalog.
+            Default: False
 
         See Also
         --------
@@ -338,9 +876,17 @@ class HaloCatalog(ParallelAnalysisInterface):
 
         """
 
-        self._run(save_halos, save_output, njobs=njobs, dynamic=dynamic)
-
-    def load(self, njobs="auto", dynamic=False):
+        self._run(
+            save_halos,
+            save_output,
+            njobs=njobs,
+            dynamic=dynamic,
+            cost_field=cost_field,
+            buffer_size=buffer_size,
+            spatial_order=spatial_order,
+        )
+
+    def load(self, njobs="auto", dynamic=False, cost_field=None, spatial_order=False):
         r"""
         Load a previously created halo catalog.
 
@@ -361,6 +907,22 @@ class HaloCatalog(ParallelAnalysisInterface):
             If True, parallelism is performed via a task queue. If njobs is set to
             "auto", behavior is controlled in the way described above.
             Default: False
+        cost_field : string
+            If not None, a field from the halo dataset, such as
+            "particle_mass", used to estimate the cost of analyzing each
+            halo.  Halos are then handed out to processors from most to least
+            expensive to balance the work between them.  Note, this also
+            changes the order of halos in the resulting catalog.
+            Default: None
+        spatial_order : bool
+            If True, halos are analyzed in order along a space-filling curve
+            so that neighboring halos are analyzed one after another and
+            by the same processor.  This can speed up callbacks that read
+            simulation data around each halo.  If cost_field is also given,
+            halos are still handed out by cost, but each processor analyzes
+            its halos in spatial order.  Note, this also changes the order
+            of halos in the resulting catalog.
+            Default: False
 
         See Also
         --------
@@ -368,7 +930,14 @@ class HaloCatalog(ParallelAnalysisInterface):
 
         """
 
-        self._run(True, False, njobs=njobs, dynamic=dynamic)
+        self._run(
+            True,
+            False,
+            njobs=njobs,
+            dynamic=dynamic,
+            cost_field=cost_field,
+            spatial_order=spatial_order,
+        )
 
     def add_callback(self, callback, *args, **kwargs):
         r"""
@@ -417,6 +986,12 @@ class HaloCatalog(ParallelAnalysisInterface):
             key parameter, taken from the halo finder dataset.  This is the way
             one pulls values for the halo from the halo dataset.
             Default : None
+        vectorized : bool
+            If True, first try to calculate the quantity for all halos at once
+            by calling it with an object whose quantities dictionary holds
+            arrays of the quantities taken from the halo dataset.  If this
+            fails, the quantity is calculated for each halo.
+            Default : False
 
         Examples
         --------
@@ -452,6 +1027,11 @@ class HaloCatalog(ParallelAnalysisInterface):
         ----------
         halo_filter : string
             The name of the filter.
+        selectivity : float, optional
+            The expected fraction of halos that will pass the filter.  When
+            several filters are ready to be run, those with the lowest
+            selectivity are run first.
+            Default: None
 
         Examples
         --------
@@ -37,7 +37,21 @@ def quantity_value(halo, field, operator, value, units):
     return eval(f"{h_value} {operator} {value}")
 
 
-add_filter("quantity_value", quantity_value)
+def _quantity_value_requires(field, *args, **kwargs):
+    return (field,)
+
+
+def _quantity_value_vectorized(quantities, field, operator, value, units):
+    h_value = quantities[field].in_units(units).to_ndarray()  # noqa: F841
+    return eval(f"h_value {operator} {value}")
+
+
+add_filter(
+    "quantity_value",
+    quantity_value,
+    requires=_quantity_value_requires,
+    vectorized=_quantity_value_vectorized,
+)
 
 
 def not_subhalo(halo, field_type="halos"):
@@ -57,7 +71,11 @@ def not_subhalo(halo, field_type="halos"):
     )
 
 
-add_filter("not_subhalo", not_subhalo)
+def _not_subhalo_requires(*args, **kwargs):
+    return ("particle_identifier",)
+
+
+add_filter("not_subhalo", not_subhalo, requires=_not_subhalo_requires)
 
 
 def _create_parent_dict(data_source, ptype="halos"):
@@ -7,11 +7,49 @@ Halo object.
 
 
 class Halo:
+    _base_attributes = ("halo_catalog", "data_source", "index", "quantities", "_memo")
+
     def __init__(self, halo_catalog, data_source, index):
         self.halo_catalog = halo_catalog
         self.data_source = data_source
         self.index = index
         self.quantities = {}
+        self._memo = {}
+
+    def _reset(self, data_source, index):
+        """
+        Prepare this object to be reused for another halo.
+
+        Any attributes added by callbacks are removed.
+        """
+
+        if len(self.__dict__) > len(self._base_attributes):
+            for attr in list(self.__dict__):
+                if attr not in self._base_attributes:
+                    delattr(self, attr)
+        self.data_source = data_source
+        self.index = index
+        self.quantities.clear()
+        self._memo.clear()
+
+    def cached(self, function, *args, **kwargs):
+        """
+        Return function(halo, *args, **kwargs), reusing the result of a
+        previous call with the same arguments on this halo.
+
+        Results are kept until the analysis of this halo is finished.
+        Calls with unhashable arguments are not cached.
+        """
+
+        key = (function, args, tuple(sorted(kwargs.items())))
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+        except TypeError:
+            return function(self, *args, **kwargs)
+        value = self._memo[key] = function(self, *args, **kwargs)
+        return value
 
     def _get_field_value(self, fieldname):
         return self.data_source[fieldname][self.index]
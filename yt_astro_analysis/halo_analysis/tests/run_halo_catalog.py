@@ -0,0 +1,92 @@
+import os
+import sys
+from unittest import mock
+
+import numpy as np
+from mpi4py import MPI
+
+import yt
+from yt.data_objects.selection_objects.data_selection_objects import (
+    YTSelectionContainer,
+)
+from yt.loaders import load
+from yt_astro_analysis.halo_analysis import HaloCatalog, add_callback
+
+yt.enable_parallelism()
+
+test_name = sys.argv[1]
+data_dir = sys.argv[2]
+comm = MPI.Comm.Get_parent()
+
+halos_ds = load(os.path.join(data_dir, "halos.0.h5"))
+
+processed_halos = []
+
+
+def _record_halo(halo):
+    processed_halos.append(int(halo.quantities["particle_identifier"]))
+
+
+add_callback("record_halo", _record_halo)
+
+
+def broadcast_field_data():
+    hc = HaloCatalog(halos_ds=halos_ds, output_dir=data_dir)
+    ad = halos_ds.all_data()
+    if hc.comm.rank == 0:
+        ad.get_data([("all", "particle_identifier"), ("all", "particle_mass")])
+        ids = ad.field_data["all", "particle_identifier"].d.astype(int)
+        # non-numeric fields are pickled
+        ad.field_data["all", "halo_name"] = np.array([f"halo_{i}" for i in ids])
+    hc._broadcast_field_data(ad)
+
+    fields = {}
+    for field, values in ad.field_data.items():
+        units = str(getattr(values, "units", ""))
+        fields[field[1]] = (values.dtype.str, units, np.asarray(values))
+    return fields
+
+
+def create_catalog():
+    hc = HaloCatalog(
+        halos_ds=halos_ds, output_dir=os.path.join(data_dir, "parallel_catalogs")
+    )
+    hc.create()
+    return hc.comm.rank
+
+
+def dynamic_dispatch():
+    hc = HaloCatalog(halos_ds=halos_ds, output_dir=data_dir)
+    hc.add_filter("quantity_value", "particle_mass", ">", 1e13, "Msun")
+    hc.add_callback("record_halo")
+    hc.create(save_output=False, njobs=-1, dynamic=True)
+    return processed_halos
+
+
+def parallel_read():
+    get_data = YTSelectionContainer.get_data
+    n_reads = []
+
+    def _get_data(self, fields=None):
+        n_fields = len(self.field_data)
+        rval = get_data(self, fields)
+        n_reads.append(len(self.field_data) - n_fields)
+        return rval
+
+    reads = {}
+    for parallel in (False, True):
+        del n_reads[:]
+        hc = HaloCatalog(
+            halos_ds=halos_ds,
+            output_dir=os.path.join(data_dir, f"parallel_read_{parallel}"),
+            parallel_read=parallel,
+        )
+        with mock.patch.object(YTSelectionContainer, "get_data", _get_data):
+            hc.create()
+        reads[parallel] = sum(n_reads)
+    return reads
+
+
+result = globals()[test_name]()
+comm.send(result, dest=0)
+comm.Disconnect()
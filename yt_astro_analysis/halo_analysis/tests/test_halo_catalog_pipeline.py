@@ -0,0 +1,642 @@
+"""
+HaloCatalog pipeline unit tests
+
+
+
+"""
+
+# -----------------------------------------------------------------------------
+# Copyright (c) 2017, yt Development Team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file COPYING.txt, distributed with this software.
+# -----------------------------------------------------------------------------
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+from unittest import TestCase, mock
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+
+from yt.data_objects.selection_objects.data_selection_objects import (
+    YTSelectionContainer,
+)
+from yt.frontends.ytdata.utilities import save_as_dataset
+from yt.loaders import load
+from yt.testing import fake_random_ds
+from yt.utilities.on_demand_imports import _h5py as h5py
+from yt_astro_analysis.halo_analysis import (
+    HaloCatalog,
+    add_callback,
+    add_filter,
+    add_quantity,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog import analysis_pipeline
+from yt_astro_analysis.halo_analysis.halo_catalog.analysis_pipeline import (
+    AnalysisPipeline,
+)
+from yt_astro_analysis.halo_analysis.halo_catalog.halo_catalog import (
+    _min_stream_chunk_size,
+    _morton_keys,
+)
+
+n_halos = 200
+mass_cut = 1e13
+
+
+def _make_halos_ds(tmpdir):
+    "Write a small halo catalog and load it."
+
+    ds = fake_random_ds(16, particles=10)
+    rs = np.random.RandomState(0x4D3D3D3)
+    data = {
+        "particle_identifier": ds.arr(np.arange(n_halos, dtype=float), ""),
+        "particle_mass": ds.arr(10 ** rs.uniform(10, 15, n_halos), "Msun"),
+        "virial_radius": ds.arr(rs.uniform(10, 100, n_halos), "kpc"),
+    }
+    for ax in "xyz":
+        data["particle_position_" + ax] = ds.arr(rs.uniform(0, 1, n_halos), "unitary")
+        data["particle_velocity_" + ax] = ds.arr(rs.normal(0, 100, n_halos), "km/s")
+
+    fn = os.path.join(tmpdir, "halos.0.h5")
+    save_as_dataset(
+        ds,
+        fn,
+        data,
+        field_types={field: "." for field in data},
+        extra_attrs={"data_type": "halo_catalog", "num_halos": n_halos},
+    )
+    return load(fn)
+
+
+def _expected_ids(hds, mass_cut=mass_cut):
+    mass = hds.all_data()["all", "particle_mass"].to("Msun").d
+    return np.flatnonzero(mass > mass_cut)
+
+
+def _catalog_column(hc, key):
+    return hc.catalog[key]
+
+
+def _catalog_ids(hc):
+    return np.sort(_catalog_column(hc, "particle_identifier").astype(int))
+
+
+def _reduce_mass(halo):
+    halo.quantities["particle_mass"] = halo.quantities["particle_mass"] * 1e-3
+
+
+add_callback("test_reduce_mass", _reduce_mass)
+
+
+def _mass_above(halo, value):
+    return halo.quantities["particle_mass"].to("Msun").d > value
+
+
+def _mass_above_requires(value):
+    return ("particle_mass",)
+
+
+add_filter("test_mass_above", _mass_above, requires=_mass_above_requires)
+
+
+def _mass_above_vectorized(quantities, value):
+    return quantities["particle_mass"].to("Msun").d > value
+
+
+add_filter(
+    "test_mass_above_vectorized",
+    _mass_above,
+    requires=_mass_above_requires,
+    vectorized=_mass_above_vectorized,
+)
+
+
+def _set_factor(halo, factor):
+    halo.factor = factor
+
+
+add_callback("test_set_factor", _set_factor)
+
+
+def _has_factor(halo):
+    return hasattr(halo, "factor")
+
+
+add_quantity("test_has_factor", _has_factor)
+
+
+def _radius_kpc(halo):
+    return halo.quantities["virial_radius"].to("kpc")
+
+
+add_quantity("test_radius_kpc", _radius_kpc)
+
+
+def _copy_quantities(halo):
+    halo.quantities = dict(halo.quantities)
+
+
+add_callback("test_copy_quantities", _copy_quantities)
+
+
+def _scaled_mass(halo):
+    return halo.quantities["particle_mass"] * halo.factor
+
+
+add_quantity("test_scaled_mass", _scaled_mass)
+
+
+def _mass_squared(halo):
+    return halo.quantities["particle_mass"] ** 2
+
+
+add_quantity("test_mass_squared", _mass_squared)
+
+
+def _mixed_type(halo):
+    index = int(halo.quantities["particle_identifier"])
+    if index < n_halos // 2:
+        return index
+    return index + 0.5
+
+
+add_quantity("test_mixed_type", _mixed_type)
+
+
+def _name(halo):
+    return "h" * (1 + int(halo.quantities["particle_identifier"]) % 13)
+
+
+add_quantity("test_name", _name)
+
+_n_calls = []
+
+
+def _counted_mass(halo):
+    _n_calls.append(1)
+    return halo.quantities["particle_mass"]
+
+
+def _cached_mass(halo):
+    return halo.cached(_counted_mass)
+
+
+add_quantity("test_cached_mass", _cached_mass)
+
+
+def _read_catalog(output_dir):
+    "Read the fields and units of all catalog files, sorted by halo id."
+
+    fields = {}
+    for filename in sorted(glob.glob(os.path.join(output_dir, "*.h5"))):
+        with h5py.File(filename, mode="r") as fh:
+            for field in fh:
+                values, units = fields.setdefault(field, ([], set()))
+                values.append(fh[field][()])
+                units.add(fh[field].attrs["units"])
+
+    fields = {
+        field: (np.concatenate(values), units.pop())
+        for field, (values, units) in fields.items()
+        if len(units) == 1
+    }
+    order = np.argsort(fields["particle_identifier"][0])
+    return {field: (values[order], units) for field, (values, units) in fields.items()}
+
+
+def _count_reads():
+    """
+    Patch get_data to record the number of fields read from disk by
+    each call.
+    """
+
+    reads = []
+    get_data = YTSelectionContainer.get_data
+
+    def _get_data(self, fields=None):
+        n_fields = len(self.field_data)
+        rval = get_data(self, fields)
+        reads.append(len(self.field_data) - n_fields)
+        return rval
+
+    return reads, mock.patch.object(YTSelectionContainer, "get_data", _get_data)
+
+
+class HaloCatalogPipelineTest(TestCase):
+    def setUp(self):
+        self.curdir = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.hds = _make_halos_ds(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.curdir)
+        shutil.rmtree(self.tmpdir)
+
+    def _run_parallel(self, test_name, nprocs):
+        "Run a function from run_halo_catalog.py and get the result of each rank."
+
+        from mpi4py import MPI
+
+        filename = os.path.join(os.path.dirname(__file__), "run_halo_catalog.py")
+        # otherwise, processes may start in a removed temporary directory
+        # left over from an earlier test
+        info = MPI.Info.Create()
+        info.Set("wdir", self.tmpdir)
+        comm = MPI.COMM_SELF.Spawn(
+            sys.executable,
+            args=[filename, test_name, self.tmpdir],
+            maxprocs=nprocs,
+            info=info,
+        )
+        info.Free()
+        results = [comm.recv(source=rank) for rank in range(nprocs)]
+        comm.Disconnect()
+        return results
+
+    def test_optimize_filter_results(self):
+        hds = self.hds
+
+        catalogs = []
+        for optimize in (True, False):
+            hc = HaloCatalog(halos_ds=hds)
+            hc.pipeline.optimize = optimize
+            hc.add_quantity("particle_mass", from_data_source=True, field_type="all")
+            hc.add_filter("test_mass_above", mass_cut, selectivity=0.5)
+            hc.add_filter("quantity_value", "virial_radius", "<", 50, "kpc")
+            hc.create(save_output=False)
+            catalogs.append(hc)
+
+        for key in ("particle_identifier", "particle_mass"):
+            assert_equal(
+                _catalog_column(catalogs[0], key), _catalog_column(catalogs[1], key)
+            )
+        radius = hds.all_data()["all", "virial_radius"].to("kpc").d
+        expected = np.intersect1d(_expected_ids(hds), np.flatnonzero(radius < 50))
+        assert_equal(_catalog_ids(catalogs[0]), expected)
+
+    def test_filter_after_callback(self):
+        hds = self.hds
+
+        hc = HaloCatalog(halos_ds=hds)
+        hc.add_callback("test_reduce_mass")
+        hc.add_filter("test_mass_above", mass_cut)
+        hc.create(save_output=False)
+
+        assert_equal(_catalog_ids(hc), _expected_ids(hds, mass_cut=1e3 * mass_cut))
+
+    def test_quantity_after_callback(self):
+        hc = HaloCatalog(halos_ds=self.hds)
+        hc.add_callback("test_set_factor", 1)
+        hc.add_quantity("test_scaled_mass")
+        hc.add_callback("test_set_factor", 2)
+        hc.add_quantity("test_scaled_mass")
+        hc.create(save_output=False)
+
+        assert_equal(
+            _catalog_column(hc, "test_scaled_mass"),
+            2 * _catalog_column(hc, "particle_mass"),
+        )
+
+    def test_halo_cached(self):
+        hc = HaloCatalog(halos_ds=self.hds)
+        hc.add_quantity("test_cached_mass")
+        hc.add_quantity("test_cached_mass")
+        del _n_calls[:]
+        hc.create(save_output=False)
+
+        assert len(_n_calls) == n_halos
+        assert_equal(
+            _catalog_column(hc, "test_cached_mass"),
+            _catalog_column(hc, "particle_mass"),
+        )
+
+    def test_cost_field(self):
+        hds = self.hds
+
+        hc = HaloCatalog(halos_ds=hds)
+        hc.add_filter("quantity_value", "particle_mass", ">", mass_cut, "Msun")
+        hc.create(save_output=False, cost_field="virial_radius")
+
+        assert_equal(_catalog_ids(hc), _expected_ids(hds))
+        radius = _catalog_column(hc, "virial_radius")
+        assert (np.diff(radius) <= 0).all()
+
+    def test_spatial_order(self):
+        hds = self.hds
+        ad = hds.all_data()
+        morton = _morton_keys(
+            hds, [ad["all", f"particle_position_{ax}"] for ax in "xyz"]
+        )
+
+        hc = HaloCatalog(halos_ds=hds)
+        hc.create(save_output=False, spatial_order=True)
+        halo_ids = _catalog_column(hc, "particle_identifier").astype(int)
+        assert_equal(halo_ids, np.argsort(morton, kind="stable"))
+
+        # with a cost field, each block is still analyzed in spatial order
+        hc = HaloCatalog(halos_ds=hds)
+        hc.add_filter("quantity_value", "particle_mass", ">", mass_cut, "Msun")
+        hc.create(save_output=False, cost_field="particle_mass", spatial_order=True)
+        halo_ids = _catalog_column(hc, "particle_identifier").astype(int)
+        expected = _expected_ids(hds)
+        expected = expected[np.argsort(morton[expected], kind="stable")]
+        assert_equal(halo_ids, expected)
+
+    def test_compressed_catalog(self):
+        hc = HaloCatalog(halos_ds=self.hds)
+        hc.create()
+
+        filename = os.path.join(hc.output_dir, "halos.0.h5")
+        with h5py.File(filename, mode="r") as fh:
+            assert fh.attrs["num_elements"] == n_halos
+            for field in fh:
+                dataset = fh[field]
+                assert dataset.compression == "gzip"
+                assert dataset.shuffle
+                assert dataset.chunks == (n_halos,)
+
+        ad = load(filename).all_data()
+        assert_allclose(
+            ad["halos", "particle_mass"].in_base().d,
+            _catalog_column(hc, "particle_mass"),
+        )
+
+    def test_catalog_structure(self):
+        hc = HaloCatalog(halos_ds=self.hds)
+        hc.add_quantity("test_mass_squared")
+        hc.add_quantity("test_mass_squared")
+        hc.add_quantity("test_mixed_type")
+        hc.create()
+
+        catalog = hc.catalog
+        assert catalog.size == n_halos
+        assert catalog.dtype.names.count("test_mass_squared") == 1
+        assert str(hc.catalog_units["test_mass_squared"]) == "g**2"
+        assert hc.catalog_units["test_mixed_type"] is None
+        assert catalog["test_mixed_type"].dtype.kind == "f"
+        assert_equal(catalog["test_mixed_type"][-1], n_halos - 0.5)
+
+        ds = load(os.path.join(hc.output_dir, "halos.0.h5"))
+        ad = ds.all_data()
+        assert_allclose(
+            ad["halos", "test_mass_squared"].to("g**2").d, catalog["test_mass_squared"]
+        )
+
+    def test_empty_catalog(self):
+        hc = HaloCatalog(halos_ds=self.hds)
+        hc.add_quantity("test_mass_squared")
+        hc.add_quantity("test_mass_squared")
+        hc.add_filter("quantity_value", "particle_mass", ">", 1e20, "Msun")
+        hc.create()
+
+        assert hc.catalog.size == 0
+        assert "test_mass_squared" in hc.catalog.dtype.names
+        assert os.path.exists(os.path.join(hc.output_dir, "halos.0.h5"))
+
+    def test_broadcast_field_data(self):
+        ad = self.hds.all_data()
+        results = self._run_parallel("broadcast_field_data", 3)
+
+        for field in ("particle_identifier", "particle_mass"):
+            values = ad["all", field]
+            for fields in results:
+                dtype, units, data = fields[field]
+                assert dtype == values.dtype.str
+                assert units == str(values.units)
+                assert_equal(data, values.d)
+
+        ids = ad["all", "particle_identifier"].d.astype(int)
+        names = [f"halo_{i}" for i in ids]
+        for fields in results:
+            dtype, units, data = fields["halo_name"]
+            assert dtype == results[0]["halo_name"][0]
+            assert_equal(data.tolist(), names)
+
+    def test_parallel_catalog(self):
+        hc = HaloCatalog(halos_ds=self.hds, output_dir="serial_catalogs")
+        hc.create()
+        ranks = self._run_parallel("create_catalog", 3)
+        assert ranks == [0, 1, 2]
+
+        serial = _read_catalog("serial_catalogs/halos")
+        parallel = _read_catalog("parallel_catalogs/halos")
+        assert parallel.keys() == serial.keys()
+        for field, (values, units) in serial.items():
+            assert parallel[field][1] == units
+            assert_allclose(parallel[field][0], values)
+
+    def test_vectorized_filter_after_callback(self):
+        hds = self.hds
+
+        hc = HaloCatalog(halos_ds=hds)
+        hc.add_filter("quantity_value", "particle_mass", ">", mass_cut, "Msun")
+        hc.create(save_output=False)
+        assert len(hc.pipeline._vectorized_filters) == 1
+        assert_equal(_catalog_ids(hc), _expected_ids(hds))
+
+        hc = HaloCatalog(halos_ds=hds)
+        hc.add_callback("test_reduce_mass")
+        hc.add_filter("quantity_value", "particle_mass", ">", mass_cut, "Msun")
+        hc.create(save_output=False)
+        assert len(hc.pipeline._vectorized_filters) == 0
+        assert_equal(_catalog_ids(hc), _expected_ids(hds, mass_cut=1e3 * mass_cut))
+
+    def test_custom_vectorized_filter(self):
+        hds = self.hds
+
+        hc = HaloCatalog(halos_ds=hds)
+        hc.add_filter("test_mass_above_vectorized", mass_cut)
+        hc.create(save_output=False)
+        assert len(hc.pipeline._vectorized_filters) == 1
+        assert_equal(_catalog_ids(hc), _expected_ids(hds))
+
+    def test_block_dispatch(self):
+        hds = self.hds
+
+        for njobs in (1, 4):
+            hc = HaloCatalog(halos_ds=hds)
+            hc.add_filter("quantity_value", "particle_mass", ">", mass_cut, "Msun")
+            hc.create(save_output=False, njobs=njobs)
+            assert_equal(_catalog_ids(hc), _expected_ids(hds))
+
+    def test_dynamic_dispatch(self):
+        results = self._run_parallel("dynamic_dispatch", 4)
+
+        # rank 0 only hands out halos, but every worker should get some
+        assert results[0] == []
+        for halo_ids in results[1:]:
+            assert len(halo_ids) > 0
+        halo_ids = np.sort(np.concatenate(results[1:]))
+        assert_equal(halo_ids, _expected_ids(self.hds))
+
+    def test_compiled_actions(self):
+        catalogs = []
+        for compile_actions in (True, False):
+            hc = HaloCatalog(halos_ds=self.hds)
+            hc.add_callback("test_copy_quantities")
+            hc.add_quantity("test_mass_squared")
+            hc.add_callback("test_set_factor", 2)
+            hc.add_quantity("test_scaled_mass")
+            hc.add_filter("test_mass_above", mass_cut)
+            if compile_actions:
+                hc.create(save_output=False)
+                assert hc.pipeline._compiled_actions is not None
+            else:
+                with mock.patch.object(AnalysisPipeline, "_compile_actions"):
+                    hc.create(save_output=False)
+                assert hc.pipeline._compiled_actions is None
+            catalogs.append(hc.catalog)
+
+        assert_equal(catalogs[0], catalogs[1])
+        assert_equal(
+            catalogs[0]["test_mass_squared"], catalogs[0]["particle_mass"] ** 2
+        )
+        assert_equal(catalogs[0]["test_scaled_mass"], 2 * catalogs[0]["particle_mass"])
+        assert_equal(
+            np.sort(catalogs[0]["particle_identifier"]), _expected_ids(self.hds)
+        )
+
+    def test_halo_reuse(self):
+        hc = HaloCatalog(halos_ds=self.hds)
+        hc.add_quantity("test_has_factor")
+        hc.add_callback("test_set_factor", 2)
+        hc.add_quantity("test_scaled_mass")
+        hc.create(save_output=False)
+
+        # attributes added by callbacks must not carry over to the next halo
+        assert hc.catalog.size == n_halos
+        assert not hc.catalog["test_has_factor"].any()
+        assert_equal(hc.catalog["test_scaled_mass"], 2 * hc.catalog["particle_mass"])
+        assert hc._halo_pool is None
+        assert hc._field_cache is None
+
+        hc.load()
+        assert len(hc.halo_list) == n_halos
+        assert len({id(halo) for halo in hc.halo_list}) == n_halos
+        for halo in hc.halo_list:
+            assert halo.factor == 2
+
+    def test_vectorized_quantity(self):
+        catalogs = []
+        for vectorized in (False, True):
+            hc = HaloCatalog(halos_ds=self.hds)
+            hc.add_quantity("test_mass_squared", vectorized=vectorized)
+            with mock.patch.object(analysis_pipeline.mylog, "warning") as warning:
+                hc.create(save_output=False)
+            assert not warning.called
+            catalogs.append(hc.catalog)
+            assert_equal(
+                hc.catalog["test_mass_squared"], hc.catalog["particle_mass"] ** 2
+            )
+        assert_equal(catalogs[0], catalogs[1])
+
+    def test_vectorized_quantity_after_callback(self):
+        hc = HaloCatalog(halos_ds=self.hds)
+        hc.add_callback("test_reduce_mass")
+        hc.add_quantity("test_mass_squared", vectorized=True)
+        with mock.patch.object(analysis_pipeline.mylog, "warning") as warning:
+            hc.create(save_output=False)
+
+        # the quantity falls back to being calculated for each halo
+        assert warning.call_count == 1
+        assert "test_mass_squared" in warning.call_args[0]
+        mass = self.hds.all_data()["all", "particle_mass"] * 1e-3
+        expected = (mass**2).to(hc.catalog_units["test_mass_squared"]).d
+        assert_allclose(hc.catalog["test_mass_squared"], expected)
+
+    def test_streamed_catalog(self):
+        n_expected = _expected_ids(self.hds).size
+
+        results = []
+        for buffer_size in (None, 7, 10 * n_halos):
+            hc = HaloCatalog(halos_ds=self.hds, output_dir=f"catalogs_{buffer_size}")
+            hc.add_filter("quantity_value", "particle_mass", ">", mass_cut, "Msun")
+            hc.add_quantity("test_name")
+            hc.add_quantity("test_mixed_type")
+            hc.create(buffer_size=buffer_size)
+            if buffer_size is not None:
+                assert hc.catalog.size == 0
+
+            filename = os.path.join(hc.output_dir, "halos.0.h5")
+            with h5py.File(filename, mode="r") as fh:
+                assert fh.attrs["num_halos"] == n_expected
+                for field in fh:
+                    dataset = fh[field]
+                    assert dataset.compression == "gzip"
+                    # chunks do not depend on how many rows are written at once
+                    if buffer_size is not None:
+                        assert dataset.chunks[0] >= _min_stream_chunk_size
+            results.append(_read_catalog(hc.output_dir))
+
+        for fields in results[1:]:
+            assert fields.keys() == results[0].keys()
+            for field, (values, units) in fields.items():
+                assert_equal(values, results[0][field][0])
+                assert units == results[0][field][1]
+
+    def test_load_base_units(self):
+        hc = HaloCatalog(halos_ds=self.hds)
+        hc.add_quantity("test_radius_kpc")
+        hc.load()
+
+        assert len(hc.halo_list) == n_halos
+        for halo in hc.halo_list[:3]:
+            radius = halo.quantities["test_radius_kpc"]
+            assert str(radius.units) == "cm"
+            assert_allclose(radius.d, halo.quantities["virial_radius"].to("cm").d)
+
+    def test_field_cache(self):
+        output_dir = os.path.join(self.tmpdir, "catalogs")
+        reads, patch = _count_reads()
+
+        with patch:
+            hc = HaloCatalog(halos_ds=self.hds, output_dir=output_dir)
+            hc.add_filter("quantity_value", "particle_mass", ">", mass_cut, "Msun")
+            hc.create()
+            catalog = hc.catalog.copy()
+            assert sum(reads) > 0
+
+            del reads[:]
+            hc.load()
+            assert sum(reads) == 0
+            assert_equal(hc.catalog, catalog)
+
+            hc.clear_field_cache()
+            hc.load()
+            assert sum(reads) > 0
+
+            hc = HaloCatalog(
+                halos_ds=self.hds, output_dir=output_dir, field_cache_size=0
+            )
+            hc.load()
+            del reads[:]
+            hc.load()
+            assert sum(reads) > 0
+            assert_equal(hc.catalog.size, n_halos)
+
+    def test_parallel_read(self):
+        hc = HaloCatalog(halos_ds=self.hds, output_dir="serial_catalogs")
+        hc.create()
+        reads = self._run_parallel("parallel_read", 3)
+
+        # only the root reads unless all processors are asked to
+        assert reads[0][False] > 0
+        for rank_reads in reads[1:]:
+            assert rank_reads[False] == 0
+        for rank_reads in reads:
+            assert rank_reads[True] > 0
+
+        serial = _read_catalog("serial_catalogs/halos")
+        for parallel in (False, True):
+            catalog = _read_catalog(f"parallel_read_{parallel}/halos")
+            assert catalog.keys() == serial.keys()
+            for field, (values, units) in serial.items():
+                assert catalog[field][1] == units
+                assert_allclose(catalog[field][0], values)